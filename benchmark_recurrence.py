@@ -0,0 +1,86 @@
+import argparse
+import datetime
+import os
+import time
+
+from google_auth_oauthlib.flow import InstalledAppFlow
+from googleapiclient.discovery import build
+from dateutil import parser
+from dotenv import load_dotenv
+
+from recurrence import MAX_PAGE_SIZE, RecurringEventCache, fetch_events
+
+load_dotenv()
+
+SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+
+
+def instance_keys(events):
+    # Сравниваем моменты начала, а не строки: смещение в dateTime может быть записано по-разному
+    return [
+        (e['id'], parser.isoparse(e['start']['dateTime']).timestamp() if 'dateTime' in e['start'] else e['start']['date'])
+        for e in events
+    ]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description="Сравнение singleEvents=True и локального разворачивания повторяющихся событий"
+    )
+    arg_parser.add_argument('--calendar', default='primary')
+    arg_parser.add_argument('--days', type=int, default=365)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    flow = InstalledAppFlow.from_client_secrets_file(os.getenv("GOOGLE_CLIENT_SECRET_FILE"), SCOPES)
+    service = build('calendar', 'v3', credentials=flow.run_local_server(port=8080))
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    time_min = now.isoformat()
+    time_max = (now + datetime.timedelta(days=args.days)).isoformat()
+
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        server_events, server_pages = fetch_events(
+            service, args.calendar, time_min, time_max,
+            singleEvents=True, orderBy='startTime', maxResults=MAX_PAGE_SIZE
+        )
+    server_time = (time.perf_counter() - started) / args.repeat
+
+    # Все замеры усредняются по --repeat запускам, страницы считаются за один запуск
+    cache = RecurringEventCache(service)
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        cache.invalidate(args.calendar)
+        local_events = cache.events(args.calendar, time_min, time_max)
+    local_cold = (time.perf_counter() - started) / args.repeat
+    local_pages = cache.pages_fetched / args.repeat
+
+    pages_before = cache.pages_fetched
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        cache.events(args.calendar, time_min, time_max)
+    local_warm = (time.perf_counter() - started) / args.repeat
+    warm_pages = (cache.pages_fetched - pages_before) / args.repeat
+
+    print(f"Окно: {time_min} - {time_max}, экземпляров: {len(server_events)}")
+    print(f"singleEvents=True: страниц {server_pages}, {server_time:.3f} с")
+    print(f"Локально (без кэша): страниц {local_pages:g}, {local_cold:.3f} с")
+    print(f"Локально (из кэша): страниц {warm_pages:g}, {local_warm:.3f} с")
+
+    server_keys = instance_keys(server_events)
+    local_keys = instance_keys(local_events)
+    if server_keys == local_keys:
+        print("Результаты совпадают")
+    else:
+        missing = set(server_keys) - set(local_keys)
+        extra = set(local_keys) - set(server_keys)
+        print(f"Расхождения: нет локально {len(missing)}, лишних {len(extra)}")
+        for key in sorted(missing)[:10]:
+            print(f"  - {key}")
+        for key in sorted(extra)[:10]:
+            print(f"  + {key}")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,30 +7,186 @@ from telegram.ext import (
     ConversationHandler, MessageHandler, CallbackQueryHandler, filters
 )
 from google_auth_oauthlib.flow import InstalledAppFlow
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 import datetime
+import httplib2
 from dateutil import parser
 from pytz import timezone, utc
 import matplotlib.pyplot as plt
+import asyncio
+import heapq
 import io
+import logging
+import math
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from dotenv import load_dotenv
+from recurrence import MAX_PAGE_SIZE, RecurringEventCache, event_start, fetch_events
 load_dotenv()
 
 token = os.getenv("TELEGRAM_TOKEN")
 creds_file = os.getenv("GOOGLE_CLIENT_SECRET_FILE")
+# Разворачивать повторяющиеся события локально, а не через singleEvents=True
+local_recurrence = os.getenv("LOCAL_RECURRENCE_EXPANSION", "").lower() in ("1", "true", "yes")
+# Сколько календарей опрашивать одновременно и сколько секунд ждать медленные
+calendar_workers = int(os.getenv("CALENDAR_WORKERS", "4"))
+calendar_deadline = float(os.getenv("CALENDAR_DEADLINE", "10"))
 
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
+logger = logging.getLogger(__name__)
+
 def authenticate_google():
     flow = InstalledAppFlow.from_client_secrets_file(
         creds_file, SCOPES)
-    creds = flow.run_local_server(port=8080)
-    service = build('calendar', 'v3', credentials=creds)
-    return service
+    return flow.run_local_server(port=8080)
 
-calendar_service = authenticate_google()
+google_creds = authenticate_google()
+calendar_service = build('calendar', 'v3', credentials=google_creds)
 local_tz = timezone("Europe/Moscow")
+recurring_cache = RecurringEventCache(calendar_service, 'Europe/Moscow')
+thread_state = threading.local()
+
+def init_calendar_thread():
+    # httplib2 не потокобезопасен, поэтому у каждого потока пула свой клиент;
+    # таймаут не даёт зависшему календарю держать поток дольше срока
+    http = AuthorizedHttp(google_creds, http=httplib2.Http(timeout=calendar_deadline))
+    thread_state.service = build('calendar', 'v3', http=http)
+
+def thread_calendar_service():
+    return thread_state.service
+
+def calendar_pool(size):
+    # Свой пул на каждый запрос: медленные календари одного чата не занимают потоки других
+    return ThreadPoolExecutor(max_workers=min(calendar_workers, size), initializer=init_calendar_thread)
+
+def fanout_deadline(size):
+    # Предельное время всего опроса: на случай, если все потоки заняты зависшими
+    # календарями и очередь не движется
+    return calendar_deadline * math.ceil(size / calendar_workers)
+
+async def fan_out(calendar_ids, work):
+    # Опрашивает календари параллельно и отдаёт (календарь, результат, ошибка) по мере готовности.
+    # Срок каждого календаря отсчитывается с момента, когда его запрос начался, а не встал в очередь;
+    # не успевшие получают asyncio.TimeoutError
+    loop = asyncio.get_running_loop()
+    started = {}
+
+    def run(cal_id):
+        started[cal_id] = time.monotonic()
+        return work(cal_id)
+
+    executor = calendar_pool(len(calendar_ids))
+    tasks = {
+        loop.run_in_executor(executor, run, cal_id): cal_id
+        for cal_id in calendar_ids
+    }
+    pending = set(tasks)
+    hard_deadline = time.monotonic() + fanout_deadline(len(calendar_ids))
+    try:
+        while pending:
+            now = time.monotonic()
+            for task in list(pending):
+                cal_id = tasks[task]
+                if now >= hard_deadline or (cal_id in started and now - started[cal_id] >= calendar_deadline):
+                    pending.discard(task)
+                    task.cancel()
+                    yield cal_id, None, asyncio.TimeoutError()
+            if not pending:
+                break
+
+            # Просыпаемся к ближайшему сроку; календарь, начавший работу позже, успеет попасть в следующий круг
+            wake = min([now + calendar_deadline, hard_deadline] + [
+                started[tasks[task]] + calendar_deadline for task in pending if tasks[task] in started
+            ])
+            done, pending = await asyncio.wait(
+                pending, timeout=max(wake - now, 0), return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                error = task.exception()
+                yield tasks[task], None if error else task.result(), error
+    finally:
+        for task in pending:
+            task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def list_events(calendar_id, time_min, time_max, show_deleted=False, limit=None, service=None):
+    service = service or calendar_service
+    if local_recurrence:
+        return recurring_cache.events(
+            calendar_id, time_min, time_max, show_deleted=show_deleted, limit=limit, service=service
+        )
+    events, _ = fetch_events(
+        service, calendar_id, time_min, time_max, limit=limit,
+        singleEvents=True,
+        orderBy='startTime',
+        showDeleted=show_deleted,
+        maxResults=MAX_PAGE_SIZE
+    )
+    return events
+
+def selected_calendars(context: ContextTypes.DEFAULT_TYPE):
+    return context.chat_data.get('calendar_ids', ['primary'])
+
+async def fetch_calendars(calendar_ids, fetch):
+    # Кто не успел к сроку — пропускаем, ошибки логируем отдельно от таймаутов
+    results = {}
+    timed_out = []
+    errors = []
+    async for cal_id, result, error in fan_out(calendar_ids, fetch):
+        if isinstance(error, asyncio.TimeoutError):
+            timed_out.append(cal_id)
+        elif error:
+            logger.error("Ошибка при запросе календаря %s", cal_id, exc_info=error)
+            errors.append(cal_id)
+        else:
+            results[cal_id] = result
+    return results, timed_out, errors
+
+async def list_calendar_events(calendar_ids, time_min, time_max, show_deleted=False):
+    def fetch(cal_id):
+        events = list_events(cal_id, time_min, time_max, show_deleted=show_deleted, service=thread_calendar_service())
+        timed_events = []
+        undated = []
+        for event in events:
+            event = dict(event, calendarId=cal_id)
+            if 'start' in event or 'originalStartTime' in event:
+                timed_events.append((event_start(event), event))
+            else:
+                undated.append(event)
+        return timed_events, undated
+
+    results, timed_out, errors = await fetch_calendars(calendar_ids, fetch)
+
+    # Списки уже отсортированы по началу, так что сливаем их k-way merge;
+    # одно и то же событие из общих календарей берём один раз.
+    # У удалённых событий может не быть ни start, ни originalStartTime — сортировать их не по чему,
+    # поэтому они идут отдельным списком
+    merged = []
+    seen = set()
+    undated = [event for _, cal_undated in results.values() for event in cal_undated]
+    for start, event in heapq.merge(*(timed for timed, _ in results.values()), key=itemgetter(0)):
+        key = (event.get('iCalUID', event['id']), start)
+        if key not in seen:
+            seen.add(key)
+            merged.append(event)
+    return merged, undated, timed_out, errors
+
+def calendar_names(context: ContextTypes.DEFAULT_TYPE, calendar_ids):
+    names = context.chat_data.get('calendar_names', {})
+    return ', '.join(names.get(cal_id, cal_id) for cal_id in calendar_ids)
+
+def failed_calendars_text(context: ContextTypes.DEFAULT_TYPE, timed_out, errors):
+    text = ""
+    if timed_out:
+        text += f"\nНе ответили календари: {calendar_names(context, timed_out)}"
+    if errors:
+        text += f"\nОшибка при запросе календарей: {calendar_names(context, errors)}"
+    return text
 
 (
     TITLE, DATE, TIME, END_TIME, ATTENDEES, DESCRIPTION,
@@ -38,14 +194,16 @@ local_tz = timezone("Europe/Moscow")
     FIND_TIME_CONFIRM_OVERLAP,
     STATS_DATE_RANGE,
     MODIFY_SELECT_EVENT, MODIFY_CHOICE, MODIFY_FIELD,
-    TODAY_DATE
-) = range(17)
+    TODAY_DATE,
+    CALENDARS_SELECT
+) = range(18)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     menu_buttons = [
         [KeyboardButton("📅 Добавить событие"), KeyboardButton("✏️ Изменить событие")],
         [KeyboardButton("🔍 Найти свободное время"), KeyboardButton("📊 Статистика")],
-        [KeyboardButton("📖 Расписание на день"), KeyboardButton("🚫 Отмена")]
+        [KeyboardButton("📖 Расписание на день"), KeyboardButton("🗂 Календари")],
+        [KeyboardButton("🚫 Отмена")]
     ]
     reply_markup = ReplyKeyboardMarkup(menu_buttons, resize_keyboard=True)
     await update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
@@ -117,7 +275,9 @@ async def create_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         attendees = [{'email': email.strip()} for email in context.user_data['attendees'].split(',') if email.strip()]
         description = context.user_data.get('description', '')
 
-        if await check_event_overlap(start_datetime, end_datetime, [a['email'] for a in attendees]):
+        overlap, unchecked = await check_event_overlap(start_datetime, end_datetime, [a['email'] for a in attendees],
+                                                       selected_calendars(context))
+        if overlap or unchecked:
             context.user_data['pending_event'] = {
                 'summary': context.user_data['title'],
                 'description': description,
@@ -129,7 +289,12 @@ async def create_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
                 [InlineKeyboardButton("Да", callback_data='confirm_yes'),
                  InlineKeyboardButton("Нет", callback_data='confirm_no')]
             ]
-            await update.message.reply_text("Время пересекается с другим событием. Вы уверены?",
+            if overlap:
+                warning = "Время пересекается с другим событием. Вы уверены?"
+            else:
+                warning = (f"Не удалось проверить пересечения в календарях: {calendar_names(context, unchecked)}. "
+                           "Всё равно создать?")
+            await update.message.reply_text(warning,
                                             reply_markup=InlineKeyboardMarkup(buttons))
             return FIND_TIME_CONFIRM_OVERLAP
         else:
@@ -148,6 +313,7 @@ async def create_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
                 }
             }
             created_event = calendar_service.events().insert(calendarId='primary', body=event).execute()
+            recurring_cache.invalidate('primary')
             await update.message.reply_text(f"Событие создано: {created_event.get('htmlLink', 'Нет ссылки')}")
 
             notification_time = start_datetime - datetime.timedelta(minutes=5)
@@ -171,25 +337,33 @@ async def create_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         await update.message.reply_text(f"Ошибка при создании: {e}")
         return ConversationHandler.END
 
-async def check_event_overlap(start_dt, end_dt, attendees_emails):
-    items = [{'id': 'primary'}]
-    for em in attendees_emails:
-        items.append({'id': em})
-
-    body = {
-        "timeMin": start_dt.isoformat(),
-        "timeMax": end_dt.isoformat(),
-        "items": items,
-        "timeZone": 'Europe/Moscow'
-    }
-
-    freebusy_result = calendar_service.freebusy().query(body=body).execute()
-    calendars = freebusy_result.get('calendars', {})
+async def check_event_overlap(start_dt, end_dt, attendees_emails, calendar_ids=('primary',)):
+    def is_busy(cal_id):
+        body = {
+            "timeMin": start_dt.isoformat(),
+            "timeMax": end_dt.isoformat(),
+            "items": [{'id': cal_id}],
+            "timeZone": 'Europe/Moscow'
+        }
+        freebusy_result = thread_calendar_service().freebusy().query(body=body).execute()
+        calendars = freebusy_result.get('calendars', {})
+        return any(data.get('busy', []) for data in calendars.values())
 
-    for cal_id, data in calendars.items():
-        if data.get('busy', []):
-            return True
-    return False
+    # Возвращает (есть пересечение, календари, которые проверить не удалось).
+    # Достаточно первого занятого календаря, остальные не ждём
+    unchecked = []
+    responses = fan_out([*calendar_ids, *attendees_emails], is_busy)
+    try:
+        async for cal_id, busy, error in responses:
+            if error:
+                if not isinstance(error, asyncio.TimeoutError):
+                    logger.error("Ошибка при проверке занятости %s", cal_id, exc_info=error)
+                unchecked.append(cal_id)
+            elif busy:
+                return True, []
+    finally:
+        await responses.aclose()
+    return False, unchecked
 
 async def confirm_overlap(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
@@ -215,6 +389,7 @@ async def confirm_overlap(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             }
         }
         created_event = calendar_service.events().insert(calendarId='primary', body=event_body).execute()
+        recurring_cache.invalidate('primary')
         await query.edit_message_text(f"Событие создано: {created_event.get('htmlLink', 'Нет ссылки')}")
 
         # Добавляем уведомление 5 минут
@@ -242,15 +417,7 @@ async def modify_event_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     now = datetime.datetime.now(local_tz)
     end_of_year = local_tz.localize(datetime.datetime(now.year, 12, 31, 23, 59, 59))
 
-    events_result = calendar_service.events().list(
-        calendarId='primary',
-        timeMin=now.isoformat(),
-        timeMax=end_of_year.isoformat(),
-        maxResults=20,
-        singleEvents=True,
-        orderBy='startTime'
-    ).execute()
-    events = events_result.get('items', [])
+    events = list_events('primary', now.isoformat(), end_of_year.isoformat(), limit=20)
 
     if not events:
         await update.message.reply_text("Нет предстоящих событий для изменения.")
@@ -302,6 +469,7 @@ async def modify_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     elif choice == 'delete':
         event_id = context.user_data['selected_event_id']
         calendar_service.events().delete(calendarId='primary', eventId=event_id).execute()
+        recurring_cache.invalidate('primary')
         await query.edit_message_text("Событие удалено.")
         return ConversationHandler.END
     return MODIFY_FIELD
@@ -330,6 +498,7 @@ async def modify_field(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         event['description'] = new_value
 
     updated_event = calendar_service.events().update(calendarId='primary', eventId=event_id, body=event).execute()
+    recurring_cache.invalidate('primary')
     await update.message.reply_text(f"Событие обновлено: {updated_event.get('htmlLink', 'Нет ссылки')}")
     return ConversationHandler.END
 
@@ -455,7 +624,9 @@ async def select_time_slot(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     end_time = selected_slot[1]
     attendees = [{'email': email} for email in context.user_data['attendees_emails']]
 
-    if await check_event_overlap(start_time, end_time, context.user_data['attendees_emails']):
+    overlap, unchecked = await check_event_overlap(start_time, end_time, context.user_data['attendees_emails'],
+                                                   selected_calendars(context))
+    if overlap or unchecked:
         context.user_data['pending_event'] = {
             'summary': 'Встреча',
             'description': '',
@@ -467,7 +638,12 @@ async def select_time_slot(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             [InlineKeyboardButton("Да", callback_data='confirm_yes'),
              InlineKeyboardButton("Нет", callback_data='confirm_no')]
         ]
-        await query.edit_message_text("Есть пересечение с другим событием. Продолжить?",
+        if overlap:
+            warning = "Есть пересечение с другим событием. Продолжить?"
+        else:
+            warning = (f"Не удалось проверить пересечения в календарях: {calendar_names(context, unchecked)}. "
+                       "Продолжить?")
+        await query.edit_message_text(warning,
                                       reply_markup=InlineKeyboardMarkup(buttons))
         return FIND_TIME_CONFIRM_OVERLAP
     else:
@@ -485,6 +661,7 @@ async def select_time_slot(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             }
         }
         created_event = calendar_service.events().insert(calendarId='primary', body=event).execute()
+        recurring_cache.invalidate('primary')
         await query.edit_message_text(f"Встреча создана: {created_event.get('htmlLink', 'Нет ссылки')}")
 
         # Добавляем уведомление за 5 минут
@@ -521,21 +698,15 @@ async def stats_process(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         time_min = start_date.isoformat() + 'Z'
         time_max = end_date.isoformat() + 'Z'
 
-        events_result = calendar_service.events().list(
-            calendarId='primary',
-            timeMin=time_min,
-            timeMax=time_max,
-            singleEvents=True,
-            orderBy='startTime',
-            showDeleted=True
-        ).execute()
-        events = events_result.get('items', [])
+        events, undated, timed_out, errors = await list_calendar_events(
+            selected_calendars(context), time_min, time_max, show_deleted=True
+        )
 
         event_count = len([e for e in events if e.get('status') != 'cancelled'])
-        rescheduled_count = sum(1 for e in events if e.get('status') == 'cancelled')
+        rescheduled_count = sum(1 for e in events + undated if e.get('status') == 'cancelled')
         total_duration = sum(
             (parser.isoparse(e['end']['dateTime']) - parser.isoparse(e['start']['dateTime'])).total_seconds()
-            for e in events if 'dateTime' in e['start'] and 'dateTime' in e['end'] and e.get('status') != 'cancelled'
+            for e in events if e.get('status') != 'cancelled' and 'dateTime' in e['start'] and 'dateTime' in e['end']
         ) / 3600
 
         await update.message.reply_text(
@@ -543,11 +714,13 @@ async def stats_process(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
             f"Событий: {event_count}\n"
             f"Продолжительность: {total_duration:.2f} ч\n"
             f"Перенесено: {rescheduled_count}"
+            + failed_calendars_text(context, timed_out, errors)
         )
 
         date_durations = {}
         for e in events:
-            if e.get('status') == 'cancelled':
+            # События на весь день (праздники и т.п.) в загрузку по часам не входят
+            if e.get('status') == 'cancelled' or 'dateTime' not in e['start']:
                 continue
             start_dt = parser.isoparse(e['start']['dateTime']).astimezone(local_tz).date()
             duration = (parser.isoparse(e['end']['dateTime']) - parser.isoparse(e['start']['dateTime'])).total_seconds() / 3600
@@ -591,29 +764,80 @@ async def get_today_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE)
     time_min = local_tz.localize(datetime.datetime.combine(target_date, datetime.time.min)).isoformat()
     time_max = local_tz.localize(datetime.datetime.combine(target_date, datetime.time.max)).isoformat()
 
-    events_result = calendar_service.events().list(
-        calendarId='primary',
-        timeMin=time_min,
-        timeMax=time_max,
-        singleEvents=True,
-        orderBy='startTime'
-    ).execute()
-    events = events_result.get('items', [])
+    calendar_ids = selected_calendars(context)
+    events, _, timed_out, errors = await list_calendar_events(calendar_ids, time_min, time_max)
+    failed_text = failed_calendars_text(context, timed_out, errors)
 
     if not events:
-        await update.message.reply_text("На этот день нет событий.")
+        await update.message.reply_text("На этот день нет событий." + failed_text)
         return ConversationHandler.END
 
     schedule_text = f"Расписание на {target_date}:\n"
     for event in events:
-        start = event['start'].get('dateTime', event['start'].get('date'))
-        start_dt = parser.isoparse(start).astimezone(local_tz)
+        if 'dateTime' in event['start']:
+            start_text = parser.isoparse(event['start']['dateTime']).astimezone(local_tz).strftime('%H:%M')
+        else:
+            start_text = "весь день"
         title = event.get('summary', 'Без названия')
-        schedule_text += f"- {start_dt.strftime('%H:%M')} {title}\n"
+        if len(calendar_ids) > 1:
+            title += f" [{calendar_names(context, [event['calendarId']])}]"
+        schedule_text += f"- {start_text} {title}\n"
+    schedule_text += failed_text
 
     await update.message.reply_text(schedule_text)
     return ConversationHandler.END
 
+def calendars_keyboard(context: ContextTypes.DEFAULT_TYPE):
+    selected = context.user_data['selected_calendar_ids']
+    buttons = []
+    for idx, (cal_id, name) in enumerate(context.user_data['calendar_list']):
+        mark = "✅" if cal_id in selected else "⬜"
+        buttons.append([InlineKeyboardButton(f"{mark} {name}", callback_data=str(idx))])
+    buttons.append([InlineKeyboardButton("Готово", callback_data='done')])
+    return InlineKeyboardMarkup(buttons)
+
+async def calendars_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    calendar_list = []
+    page_token = None
+    while True:
+        result = calendar_service.calendarList().list(pageToken=page_token).execute()
+        calendar_list.extend(result.get('items', []))
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            break
+
+    # id календаря может не влезть в 64 байта callback_data, поэтому кнопки ссылаются на индекс
+    context.user_data['calendar_list'] = [
+        ('primary' if cal.get('primary') else cal['id'], cal.get('summaryOverride', cal.get('summary', cal['id'])))
+        for cal in calendar_list
+    ]
+    context.user_data['selected_calendar_ids'] = list(selected_calendars(context))
+    await update.message.reply_text("Выберите календари:", reply_markup=calendars_keyboard(context))
+    return CALENDARS_SELECT
+
+async def calendars_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    selected = context.user_data['selected_calendar_ids']
+
+    if query.data == 'done':
+        if not selected:
+            await query.edit_message_text("Нужно выбрать хотя бы один календарь.",
+                                          reply_markup=calendars_keyboard(context))
+            return CALENDARS_SELECT
+        context.chat_data['calendar_ids'] = selected
+        context.chat_data['calendar_names'] = dict(context.user_data['calendar_list'])
+        await query.edit_message_text(f"Выбраны календари: {calendar_names(context, selected)}")
+        return ConversationHandler.END
+
+    cal_id = context.user_data['calendar_list'][int(query.data)][0]
+    if cal_id in selected:
+        selected.remove(cal_id)
+    else:
+        selected.append(cal_id)
+    await query.edit_message_reply_markup(reply_markup=calendars_keyboard(context))
+    return CALENDARS_SELECT
+
 def main():
     application = Application.builder().token(token).build()
 
@@ -673,12 +897,21 @@ def main():
         fallbacks=[MessageHandler(filters.Regex('^🚫 Отмена$'), cancel)],
     )
 
+    calendars_handler = ConversationHandler(
+        entry_points=[MessageHandler(filters.Regex('^🗂 Календари$'), calendars_start)],
+        states={
+            CALENDARS_SELECT: [CallbackQueryHandler(calendars_toggle, pattern=r'^(\d+|done)$')],
+        },
+        fallbacks=[MessageHandler(filters.Regex('^🚫 Отмена$'), cancel)],
+    )
+
     application.add_handler(CommandHandler("start", start))
     application.add_handler(add_event_handler)
     application.add_handler(modify_event_handler)
     application.add_handler(find_time_handler)
     application.add_handler(stats_handler)
     application.add_handler(today_handler)
+    application.add_handler(calendars_handler)
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(MessageHandler(filters.Regex('^🚫 Отмена$'), cancel))
 
@@ -0,0 +1,274 @@
+import datetime
+import heapq
+import itertools
+import logging
+import re
+import time
+from operator import itemgetter
+
+from dateutil import parser, rrule, tz
+
+# Google отдаёт не больше 2500 событий на страницу
+MAX_PAGE_SIZE = 2500
+CACHE_TTL = 300
+# Перенесённый экземпляр серии может оказаться вне запрошенного окна,
+# хотя исходное время лежит внутри — поэтому загружаем окно с запасом.
+EXCEPTION_PADDING = datetime.timedelta(days=7)
+UNTIL_PATTERN = re.compile(r'UNTIL=([0-9T]+Z?)')
+
+logger = logging.getLogger(__name__)
+
+
+def _fetch_pages(list_method, limit=None, **params):
+    items = []
+    pages = 0
+    page_token = None
+    time_zone = None
+    if limit:
+        params['maxResults'] = min(limit, MAX_PAGE_SIZE)
+    while True:
+        result = list_method(pageToken=page_token, **params).execute()
+        pages += 1
+        items.extend(result.get('items', []))
+        time_zone = result.get('timeZone', time_zone)
+        page_token = result.get('nextPageToken')
+        if not page_token or (limit and len(items) >= limit):
+            return items[:limit] if limit else items, pages, time_zone
+
+
+def fetch_events(service, calendar_id, time_min, time_max, limit=None, **params):
+    items, pages, _ = _fetch_pages(
+        service.events().list, limit,
+        calendarId=calendar_id,
+        timeMin=time_min,
+        timeMax=time_max,
+        **params
+    )
+    return items, pages
+
+
+def _all_day_start(value, default_tz):
+    day = datetime.date.fromisoformat(value)
+    return datetime.datetime.combine(day, datetime.time.min).replace(tzinfo=default_tz)
+
+
+def _time_point(field, default_tz):
+    if 'dateTime' in field:
+        return parser.isoparse(field['dateTime'])
+    return _all_day_start(field['date'], default_tz)
+
+
+def event_start(event, default_tz_name='Europe/Moscow'):
+    # У отменённых экземпляров может не быть start, только originalStartTime
+    field = event.get('start') or event['originalStartTime']
+    return _time_point(field, tz.gettz(default_tz_name))
+
+
+def _original_key(field):
+    # Ключ экземпляра серии: момент начала в UTC или дата для событий на весь день
+    if 'dateTime' in field:
+        return parser.isoparse(field['dateTime']).astimezone(tz.UTC)
+    return field['date']
+
+
+def _make_instance(master, occ_start, occ_end, all_day):
+    instance = {k: v for k, v in master.items() if k != 'recurrence'}
+    instance['recurringEventId'] = master['id']
+    if all_day:
+        instance['id'] = f"{master['id']}_{occ_start:%Y%m%d}"
+        start = {'date': occ_start.date().isoformat()}
+        end = {'date': occ_end.date().isoformat()}
+    else:
+        instance['id'] = f"{master['id']}_{occ_start.astimezone(tz.UTC):%Y%m%dT%H%M%SZ}"
+        start = {'dateTime': occ_start.isoformat()}
+        end = {'dateTime': occ_end.isoformat()}
+        if 'timeZone' in master['start']:
+            start['timeZone'] = master['start']['timeZone']
+        if 'timeZone' in master['end']:
+            end['timeZone'] = master['end']['timeZone']
+    instance['start'] = start
+    instance['end'] = end
+    instance['originalStartTime'] = dict(start)
+    return instance
+
+
+def _normalize_until(line, dtstart, default_tz):
+    # Импортированные (ICS/Outlook) серии пишут UNTIL то в UTC у событий на весь день,
+    # то датой у событий со временем, а dateutil требует, чтобы UNTIL совпадал с DTSTART
+    match = UNTIL_PATTERN.search(line)
+    if not line.startswith(('RRULE:', 'EXRULE:')) or not match:
+        return line
+    value = match.group(1)
+    until = parser.isoparse(value)
+    if dtstart.tzinfo is None:
+        if until.tzinfo is None:
+            return line
+        normalized = f"{until.astimezone(default_tz):%Y%m%dT%H%M%S}"
+    else:
+        if until.tzinfo is not None:
+            return line
+        if 'T' not in value:
+            until = until.replace(hour=23, minute=59, second=59)
+        normalized = f"{until.replace(tzinfo=dtstart.tzinfo).astimezone(tz.UTC):%Y%m%dT%H%M%SZ}"
+    return line[:match.start(1)] + normalized + line[match.end(1):]
+
+
+def _series_rules(master, window_start, default_tz):
+    all_day = 'date' in master['start']
+    first_start = _time_point(master['start'], default_tz)
+    duration = _time_point(master['end'], default_tz) - first_start
+
+    if all_day:
+        dtstart = first_start.replace(tzinfo=None)
+        after = (window_start - duration).astimezone(default_tz).replace(tzinfo=None)
+    else:
+        # RRULE считается в часовом поясе события, иначе поедет время при переходе на летнее время;
+        # без timeZone сервер разворачивает серию в часовом поясе календаря
+        event_tz = None
+        if master['start'].get('timeZone'):
+            event_tz = tz.gettz(master['start']['timeZone'])
+        dtstart = first_start.astimezone(event_tz or default_tz)
+        after = window_start - duration
+
+    lines = [_normalize_until(line, dtstart, default_tz) for line in master['recurrence']]
+    rules = rrule.rrulestr('\n'.join(lines), dtstart=dtstart, forceset=True)
+    # Часть ошибок (например, EXDATE без часового пояса) dateutil выдаёт только при переборе
+    rules.after(after)
+    return rules, all_day, duration, after
+
+
+def _expand_series(master, rules, all_day, duration, after, window_end, overrides, show_deleted, default_tz):
+    for occurrence in rules.xafter(after, inc=False):
+        occ_start = occurrence.replace(tzinfo=default_tz) if all_day else occurrence
+        if occ_start >= window_end:
+            return
+        instance = _make_instance(master, occurrence, occurrence + duration, all_day)
+        override = overrides.get(_original_key(instance['originalStartTime']))
+        if override is None:
+            yield occ_start, instance
+        elif override.get('status') == 'cancelled' and show_deleted:
+            instance.update(override)
+            yield occ_start, instance
+        # Изменённые экземпляры приходят отдельными событиями и попадают в выдачу по своему времени
+
+
+def expand_events(items, time_min, time_max, default_tz_name='Europe/Moscow', show_deleted=False, fallback=None):
+    default_tz = tz.gettz(default_tz_name)
+    window_start = parser.isoparse(time_min)
+    window_end = parser.isoparse(time_max)
+
+    masters = []
+    overrides = {}
+    singles = []
+    for event in items:
+        if 'recurrence' in event:
+            if event.get('status') != 'cancelled':
+                masters.append(event)
+        elif 'recurringEventId' in event:
+            key = _original_key(event['originalStartTime'])
+            overrides.setdefault(event['recurringEventId'], {})[key] = event
+            if event.get('status') != 'cancelled':
+                singles.append(event)
+        elif event.get('status') != 'cancelled' or show_deleted:
+            singles.append(event)
+
+    streams = []
+    server_expanded = set()
+    for master in masters:
+        try:
+            rules, all_day, duration, after = _series_rules(master, window_start, default_tz)
+        except (ValueError, TypeError):
+            # Одна непонятная dateutil серия не должна ломать весь календарь
+            logger.warning("Не удалось развернуть серию %s локально", master['id'], exc_info=True)
+            if fallback is None:
+                continue
+            server_expanded.add(master['id'])
+            instances = fallback(master)
+            streams.append(sorted(
+                ((event_start(e, default_tz_name), e) for e in instances),
+                key=itemgetter(0)
+            ))
+            continue
+        streams.append(_expand_series(
+            master, rules, all_day, duration, after, window_end,
+            overrides.get(master['id'], {}), show_deleted, default_tz
+        ))
+
+    plain = []
+    for event in singles:
+        # Изменённые экземпляры развёрнутых сервером серий уже пришли из instances()
+        if 'start' not in event or event.get('recurringEventId') in server_expanded:
+            continue
+        start = _time_point(event['start'], default_tz)
+        end = _time_point(event['end'], default_tz)
+        if end > window_start and start < window_end:
+            plain.append((start, event))
+    plain.sort(key=itemgetter(0))
+    streams.append(plain)
+    return (event for _, event in heapq.merge(*streams, key=itemgetter(0)))
+
+
+class RecurringEventCache:
+    def __init__(self, service, default_tz_name='Europe/Moscow', ttl=CACHE_TTL):
+        self.service = service
+        self.default_tz_name = default_tz_name
+        self.ttl = ttl
+        self.pages_fetched = 0
+        self._entries = {}
+
+    def _load(self, service, calendar_id, window_start, window_end):
+        entry = self._entries.get(calendar_id)
+        if entry is not None:
+            fetched_at, cached_start, cached_end, items, time_zone, instances = entry
+            if time.monotonic() - fetched_at < self.ttl and cached_start <= window_start and window_end <= cached_end:
+                return items, time_zone, instances
+
+        items, pages, time_zone = _fetch_pages(
+            service.events().list,
+            calendarId=calendar_id,
+            timeMin=(window_start - EXCEPTION_PADDING).isoformat(),
+            timeMax=(window_end + EXCEPTION_PADDING).isoformat(),
+            singleEvents=False,
+            showDeleted=True,
+            maxResults=MAX_PAGE_SIZE
+        )
+        self.pages_fetched += pages
+        time_zone = time_zone or self.default_tz_name
+        # Экземпляры серий, развёрнутых сервером, кэшируются вместе с календарём
+        instances = {}
+        self._entries[calendar_id] = (time.monotonic(), window_start, window_end, items, time_zone, instances)
+        return items, time_zone, instances
+
+    def _fetch_instances(self, service, calendar_id, master, time_min, time_max, show_deleted):
+        instances, pages, _ = _fetch_pages(
+            service.events().instances,
+            calendarId=calendar_id,
+            eventId=master['id'],
+            timeMin=time_min,
+            timeMax=time_max,
+            showDeleted=show_deleted,
+            maxResults=MAX_PAGE_SIZE
+        )
+        self.pages_fetched += pages
+        return instances
+
+    def events(self, calendar_id, time_min, time_max, show_deleted=False, limit=None, service=None):
+        service = service or self.service
+        items, time_zone, instances = self._load(
+            service, calendar_id, parser.isoparse(time_min), parser.isoparse(time_max)
+        )
+
+        def fallback(master):
+            key = (master['id'], time_min, time_max, show_deleted)
+            if key not in instances:
+                instances[key] = self._fetch_instances(service, calendar_id, master, time_min, time_max, show_deleted)
+            return instances[key]
+
+        events = expand_events(items, time_min, time_max, time_zone, show_deleted, fallback)
+        return list(itertools.islice(events, limit)) if limit else list(events)
+
+    def invalidate(self, calendar_id=None):
+        if calendar_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(calendar_id, None)
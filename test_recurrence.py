@@ -0,0 +1,202 @@
+import datetime
+
+from dateutil import parser
+
+from recurrence import RecurringEventCache, expand_events
+
+
+def timed(event_id, start, end, **fields):
+    return dict(fields, id=event_id, start={'dateTime': start}, end={'dateTime': end})
+
+
+def master(event_id, start, end, *recurrence, time_zone='Europe/Moscow'):
+    event = timed(event_id, start, end, recurrence=list(recurrence))
+    if time_zone:
+        event['start']['timeZone'] = time_zone
+        event['end']['timeZone'] = time_zone
+    return event
+
+
+def starts(events):
+    return [(e['id'], e['start'].get('dateTime', e['start'].get('date'))) for e in events]
+
+
+STANDUP = master(
+    'standup', '2025-01-01T10:00:00+03:00', '2025-01-01T10:15:00+03:00',
+    'RRULE:FREQ=DAILY',
+    'EXDATE;TZID=Europe/Moscow:20250103T100000'
+)
+
+
+def test_exdate_with_tzid_skips_occurrence():
+    events = expand_events([STANDUP], '2025-01-02T00:00:00+03:00', '2025-01-05T00:00:00+03:00')
+    assert starts(events) == [
+        ('standup_20250102T070000Z', '2025-01-02T10:00:00+03:00'),
+        ('standup_20250104T070000Z', '2025-01-04T10:00:00+03:00'),
+    ]
+
+
+def test_moved_and_cancelled_overrides():
+    moved = timed(
+        'standup_20250102T070000Z', '2025-01-04T15:00:00+03:00', '2025-01-04T15:15:00+03:00',
+        recurringEventId='standup', originalStartTime={'dateTime': '2025-01-02T10:00:00+03:00'}
+    )
+    cancelled = {
+        'id': 'standup_20250104T070000Z', 'status': 'cancelled', 'recurringEventId': 'standup',
+        'originalStartTime': {'dateTime': '2025-01-04T10:00:00+03:00'}
+    }
+    items = [STANDUP, moved, cancelled]
+    window = ('2025-01-02T00:00:00+03:00', '2025-01-05T00:00:00+03:00')
+
+    assert starts(expand_events(items, *window)) == [
+        ('standup_20250102T070000Z', '2025-01-04T15:00:00+03:00'),
+    ]
+    with_deleted = list(expand_events(items, *window, show_deleted=True))
+    assert [(e['id'], e.get('status')) for e in with_deleted] == [
+        ('standup_20250104T070000Z', 'cancelled'),
+        ('standup_20250102T070000Z', None),
+    ]
+
+
+def test_rule_keeps_wall_clock_across_dst():
+    weekly = master(
+        'weekly', '2025-03-03T09:00:00-05:00', '2025-03-03T10:00:00-05:00',
+        'RRULE:FREQ=WEEKLY;COUNT=3', time_zone='America/New_York'
+    )
+    events = expand_events([weekly], '2025-03-01T00:00:00Z', '2025-04-01T00:00:00Z')
+    assert starts(events) == [
+        ('weekly_20250303T140000Z', '2025-03-03T09:00:00-05:00'),
+        ('weekly_20250310T130000Z', '2025-03-10T09:00:00-04:00'),
+        ('weekly_20250317T130000Z', '2025-03-17T09:00:00-04:00'),
+    ]
+
+
+def test_series_without_time_zone_uses_calendar_zone():
+    weekly = master(
+        'weekly', '2025-03-03T14:00:00Z', '2025-03-03T15:00:00Z',
+        'RRULE:FREQ=WEEKLY;COUNT=2', time_zone=None
+    )
+    events = expand_events([weekly], '2025-03-01T00:00:00Z', '2025-04-01T00:00:00Z', 'America/New_York')
+    assert [parser.isoparse(e['start']['dateTime']).hour for e in events] == [9, 9]
+
+
+def test_all_day_series():
+    holiday = {
+        'id': 'holiday', 'start': {'date': '2025-01-06'}, 'end': {'date': '2025-01-07'},
+        'recurrence': ['RRULE:FREQ=WEEKLY', 'EXDATE;VALUE=DATE:20250113'],
+    }
+    events = list(expand_events([holiday], '2025-01-06T00:00:00+03:00', '2025-01-27T00:00:00+03:00'))
+    assert starts(events) == [('holiday_20250106', '2025-01-06'), ('holiday_20250120', '2025-01-20')]
+    assert events[0]['end'] == {'date': '2025-01-07'}
+
+
+def test_until_in_foreign_form_is_normalised():
+    all_day = {
+        'id': 'all_day', 'start': {'date': '2025-01-01'}, 'end': {'date': '2025-01-02'},
+        'recurrence': ['RRULE:FREQ=DAILY;UNTIL=20250103T000000Z'],
+    }
+    timed_series = master(
+        'timed', '2025-01-01T10:00:00+03:00', '2025-01-01T11:00:00+03:00',
+        'RRULE:FREQ=DAILY;UNTIL=20250102'
+    )
+    events = expand_events([all_day, timed_series], '2025-01-01T00:00:00+03:00', '2025-01-10T00:00:00+03:00')
+    assert [e['id'] for e in events] == [
+        'all_day_20250101', 'timed_20250101T070000Z',
+        'all_day_20250102', 'timed_20250102T070000Z',
+        'all_day_20250103',
+    ]
+
+
+def test_broken_series_falls_back_to_server_instances():
+    broken = master(
+        'broken', '2025-01-01T10:00:00+03:00', '2025-01-01T11:00:00+03:00',
+        'RRULE:FREQ=SOMETIMES'
+    )
+    instance = timed(
+        'broken_20250102T070000Z', '2025-01-02T10:00:00+03:00', '2025-01-02T11:00:00+03:00',
+        recurringEventId='broken'
+    )
+    window = ('2025-01-02T00:00:00+03:00', '2025-01-04T00:00:00+03:00')
+
+    events = expand_events([broken, STANDUP], *window, fallback=lambda m: [instance])
+    assert [e['id'] for e in events] == ['broken_20250102T070000Z', 'standup_20250102T070000Z']
+    assert [e['id'] for e in expand_events([broken], *window)] == []
+
+
+def test_window_edges():
+    # Событие, закончившееся ровно в начале окна, не попадает; начавшееся раньше и идущее — попадает
+    events = expand_events([STANDUP], '2025-01-02T10:15:00+03:00', '2025-01-04T10:00:00+03:00')
+    assert [e['id'] for e in events] == []
+    events = expand_events([STANDUP], '2025-01-02T10:14:00+03:00', '2025-01-04T10:00:01+03:00')
+    assert [e['id'] for e in events] == ['standup_20250102T070000Z', 'standup_20250104T070000Z']
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+class FakeEvents:
+    def __init__(self, items):
+        self.items = items
+        self.calls = 0
+
+    def list(self, **params):
+        self.calls += 1
+        return FakeRequest({'items': self.items, 'timeZone': 'Europe/Moscow'})
+
+
+class FakeService:
+    def __init__(self, items):
+        self._events = FakeEvents(items)
+
+    def events(self):
+        return self._events
+
+
+def test_cache_limit_and_reuse():
+    service = FakeService([STANDUP])
+    cache = RecurringEventCache(service)
+    now = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    time_min = now.isoformat()
+    time_max = (now + datetime.timedelta(days=365)).isoformat()
+
+    events = cache.events('primary', time_min, time_max, limit=3)
+    assert [e['id'] for e in events] == [
+        'standup_20250101T070000Z', 'standup_20250102T070000Z', 'standup_20250104T070000Z'
+    ]
+    assert len(cache.events('primary', time_min, time_max)) == 364
+    assert service.events().calls == 1
+
+    cache.invalidate('primary')
+    cache.events('primary', time_min, time_max, limit=1)
+    assert service.events().calls == 2
+
+
+def test_fallback_instances_are_cached():
+    broken = master(
+        'broken', '2025-01-01T10:00:00+03:00', '2025-01-01T11:00:00+03:00',
+        'RRULE:FREQ=SOMETIMES'
+    )
+    instance = timed(
+        'broken_20250102T070000Z', '2025-01-02T10:00:00+03:00', '2025-01-02T11:00:00+03:00',
+        recurringEventId='broken'
+    )
+    service = FakeService([broken])
+    instance_calls = []
+
+    def instances(**params):
+        instance_calls.append(params)
+        return FakeRequest({'items': [instance]})
+
+    service.events().instances = instances
+    cache = RecurringEventCache(service)
+    window = ('2025-01-02T00:00:00+03:00', '2025-01-04T00:00:00+03:00')
+
+    assert [e['id'] for e in cache.events('primary', *window)] == ['broken_20250102T070000Z']
+    assert [e['id'] for e in cache.events('primary', *window)] == ['broken_20250102T070000Z']
+    assert len(instance_calls) == 1
+    assert cache.pages_fetched == 2